@@ -2,11 +2,21 @@ import torch
 from diffusers import StableDiffusionPipeline
 import os
 import argparse
+import json
+import time
 from datetime import datetime
+from guidance import CFG_MODES, GUIDANCE_CURVES, GuidanceSchedule
+from onnx_backend import ONNX_PATH, seeded_kwargs, setup_onnx_pipeline
+from profiling import PROFILER, span
+from token_merging import apply_token_merging, reset_token_merging
 
-def setup_anything_v5_pipeline():
+# Enhanced negative prompt for better anime quality
+ENHANCED_NEGATIVE = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, artist name"
+
+def setup_anything_v5_pipeline(device=None):
     """Initialize the Anything V5 pipeline for anime-style generation"""
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"💻 Using device: {device}")
     
     model_path = "models/checkpoints/anything-v5"
@@ -34,13 +44,37 @@ def setup_anything_v5_pipeline():
     print("✅ Anything V5 model loaded and ready for Battle-Eternal style generation!")
     return pipe
 
-def generate_battle_eternal_image(pipe, prompt, negative_prompt="", steps=25, guidance=8.0, width=512, height=768, seed=None):
+def build_negative_prompt(negative_prompt=""):
+    """Prepend a custom negative prompt to the enhanced anime negative prompt"""
+    if negative_prompt:
+        return f"{negative_prompt}, {ENHANCED_NEGATIVE}"
+    return ENHANCED_NEGATIVE
+
+def run_seeded(pipe, prompt, negative_prompt, seed, steps, guidance, width, height):
+    """Generate one image from a seed and return (image, seconds)"""
+    generator = torch.Generator().manual_seed(seed)
+    reset_token_merging(pipe)
+    start = time.perf_counter()
+    with torch.no_grad():
+        result = pipe(
+            prompt,
+            negative_prompt=negative_prompt,
+            num_inference_steps=steps,
+            guidance_scale=guidance,
+            height=height,
+            width=width,
+            **seeded_kwargs(pipe, generator, height, width)
+        )
+    return result.images[0], time.perf_counter() - start
+
+def generate_battle_eternal_image(pipe, prompt, negative_prompt="", steps=25, guidance=8.0, width=512, height=768, seed=None,
+                                  guidance_schedule=None):
     """Generate a Battle-Eternal style image using Anything V5"""
     
-    # Enhanced negative prompt for better anime quality
-    enhanced_negative = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, artist name"
-    if negative_prompt:
-        enhanced_negative = f"{negative_prompt}, {enhanced_negative}"
+    if guidance_schedule is None:
+        guidance_schedule = GuidanceSchedule()
+    
+    enhanced_negative = build_negative_prompt(negative_prompt)
     
     if seed is not None:
         torch.manual_seed(seed)
@@ -50,7 +84,9 @@ def generate_battle_eternal_image(pipe, prompt, negative_prompt="", steps=25, gu
     print(f"   Negative prompt: {enhanced_negative}")
     print(f"   Steps: {steps}, Guidance: {guidance}, Size: {width}x{height}")
     
-    with torch.no_grad():
+    reset_token_merging(pipe)
+    with torch.no_grad(), span("generate", steps=steps, width=width, height=height), \
+            guidance_schedule.apply(pipe, guidance) as schedule_kwargs:
         result = pipe(
             prompt,
             negative_prompt=enhanced_negative,
@@ -58,11 +94,207 @@ def generate_battle_eternal_image(pipe, prompt, negative_prompt="", steps=25, gu
             guidance_scale=guidance,
             height=height,
             width=width,
-            generator=torch.Generator().manual_seed(seed) if seed else None
+            **seeded_kwargs(pipe, torch.Generator().manual_seed(seed) if seed else None, height, width),
+            **schedule_kwargs
         )
     
+    if guidance_schedule.steps:
+        print(f"⚡ UNet evaluations: {guidance_schedule.unet_evals} ({guidance_schedule.unet_evals_saved} saved vs full CFG)")
+    
     return result.images[0]
 
+def iter_batch_jobs(batch_file, defaults, run_id):
+    """Stream job records from a JSONL file one line at a time.
+
+    Yields (line_number, job, error) tuples. Malformed lines yield an error
+    instead of a job so the run can record them and keep going. Jobs without
+    an output name get one that includes run_id, so reruns don't overwrite
+    earlier images.
+    """
+    with open(batch_file, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict) or not record.get("prompt"):
+                    raise ValueError("job record needs a 'prompt' field")
+                output = record.get("output")
+                if output is None:
+                    output = f"batch_{run_id}_{line_number:06d}.png"
+                for field, value in [("prompt", record["prompt"]), ("output", output)]:
+                    if not isinstance(value, str):
+                        raise TypeError(f"'{field}' must be a string, got {type(value).__name__}")
+                job = {
+                    "line": line_number,
+                    "prompt": record["prompt"],
+                    "negative": record.get("negative", defaults["negative"]),
+                    "seed": record.get("seed", defaults["seed"]),
+                    "steps": int(record.get("steps", defaults["steps"])),
+                    "guidance": float(record.get("guidance", defaults["guidance"])),
+                    "width": int(record.get("width", defaults["width"])),
+                    "height": int(record.get("height", defaults["height"])),
+                    "output": output,
+                }
+                if job["seed"] is None:
+                    job["seed"] = int.from_bytes(os.urandom(4), "little") % 1000000
+                else:
+                    job["seed"] = int(job["seed"])
+                yield line_number, job, None
+            except (ValueError, TypeError, json.JSONDecodeError) as e:
+                yield line_number, None, str(e)
+
+def resolve_output_path(output_dir, output):
+    """Normalise a job's output name, rejecting paths that escape output_dir"""
+    root = os.path.abspath(output_dir)
+    path = os.path.abspath(os.path.join(root, output))
+    if os.path.isabs(output) or path == root or os.path.commonpath([root, path]) != root:
+        raise ValueError(f"output must be a relative path inside {output_dir}: {output}")
+    return os.path.join(output_dir, os.path.relpath(path, root))
+
+def bucket_key(job):
+    """Jobs sharing resolution, steps and guidance can run in one pipeline call"""
+    return (job["width"], job["height"], job["steps"], job["guidance"])
+
+def generate_batch(pipe, jobs, guidance_schedule=None):
+    """Generate one image per job with a single batched pipeline call.
+
+    All jobs must share the same bucket_key. Each job keeps its own seed via
+    a per-image generator, so results match single-image runs.
+    """
+    width, height, steps, guidance = bucket_key(jobs[0])
+    if guidance_schedule is None:
+        guidance_schedule = GuidanceSchedule()
+    
+    reset_token_merging(pipe)
+    with torch.no_grad(), span("generate", batch_size=len(jobs), steps=steps, width=width, height=height), \
+            guidance_schedule.apply(pipe, guidance) as schedule_kwargs:
+        result = pipe(
+            [job["prompt"] for job in jobs],
+            negative_prompt=[build_negative_prompt(job["negative"]) for job in jobs],
+            num_inference_steps=steps,
+            guidance_scale=guidance,
+            height=height,
+            width=width,
+            **seeded_kwargs(pipe, [torch.Generator().manual_seed(job["seed"]) for job in jobs], height, width),
+            **schedule_kwargs
+        )
+    
+    return result.images
+
+def run_batch_bucket(pipe, jobs, output_dir, results, guidance_schedule=None):
+    """Run one bucket, save its images and append a result record per job"""
+    width, height, steps, guidance = bucket_key(jobs[0])
+    print(f"🎨 Generating batch of {len(jobs)} ({width}x{height}, {steps} steps, guidance {guidance})")
+    
+    start = time.perf_counter()
+    try:
+        images = generate_batch(pipe, jobs, guidance_schedule)
+        error = None
+    except Exception as e:
+        images = [None] * len(jobs)
+        error = str(e)
+        print(f"❌ Batch failed: {e}")
+    # Pipeline time is shared by the whole bucket, so split it evenly
+    generate_seconds = (time.perf_counter() - start) / len(jobs)
+    
+    ok_count = 0
+    for job, image in zip(jobs, images):
+        record = {
+            "line": job["line"],
+            "output": job["output"],
+            "prompt": job["prompt"],
+            "seed": job["seed"],
+            "steps": steps,
+            "guidance": guidance,
+            "width": width,
+            "height": height,
+            "batch_size": len(jobs),
+            "generate_seconds": round(generate_seconds, 4),
+        }
+        if guidance_schedule is not None and guidance_schedule.steps:
+            record["unet_evals"] = guidance_schedule.unet_evals
+        if error is not None:
+            record.update(status="error", error=error)
+        else:
+            save_start = time.perf_counter()
+            try:
+                filename = job["path"]
+                os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+                if os.path.exists(filename):
+                    print(f"⚠️  Line {job['line']} overwrites {filename}")
+                    record["overwrote"] = True
+                image.save(filename)
+                record.update(status="ok", path=filename)
+                ok_count += 1
+            except Exception as e:
+                record.update(status="error", error=str(e))
+            record["save_seconds"] = round(time.perf_counter() - save_start, 4)
+        results.write(json.dumps(record, ensure_ascii=False) + "\n")
+    results.flush()
+    
+    return ok_count
+
+def run_batch_file(pipe, batch_file, defaults, output_dir="output", results_file=None, batch_size=4, max_pending=None,
+                   guidance_schedule=None):
+    """Process a JSONL job file with bounded memory.
+
+    Jobs are grouped into buckets by bucket_key and a bucket is generated as
+    soon as it holds batch_size jobs. At most max_pending jobs are held at
+    once; past that the fullest bucket is flushed early, so memory stays
+    constant no matter how many lines the file has.
+    """
+    if max_pending is None:
+        max_pending = batch_size * 8
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if results_file is None:
+        results_file = os.path.join(output_dir, f"batch_results_{timestamp}.jsonl")
+    os.makedirs(os.path.dirname(results_file) or ".", exist_ok=True)
+    
+    print(f"📄 Streaming jobs from {batch_file}")
+    buckets = {}
+    pending = 0
+    total = 0
+    succeeded = 0
+    run_start = time.perf_counter()
+    
+    with open(results_file, 'w', encoding='utf-8') as results:
+        for line_number, job, error in iter_batch_jobs(batch_file, defaults, timestamp):
+            total += 1
+            if error is None:
+                try:
+                    job["path"] = resolve_output_path(output_dir, job["output"])
+                except (ValueError, TypeError) as e:
+                    error = str(e)
+            if error is not None:
+                print(f"⚠️  Skipping line {line_number}: {error}")
+                results.write(json.dumps({"line": line_number, "status": "error", "error": error}) + "\n")
+                continue
+            
+            key = bucket_key(job)
+            buckets.setdefault(key, []).append(job)
+            pending += 1
+            
+            if len(buckets[key]) >= batch_size:
+                flush_key = key
+            elif pending > max_pending:
+                flush_key = max(buckets, key=lambda k: len(buckets[k]))
+            else:
+                continue
+            
+            jobs = buckets.pop(flush_key)
+            pending -= len(jobs)
+            succeeded += run_batch_bucket(pipe, jobs, output_dir, results, guidance_schedule)
+        
+        for jobs in buckets.values():
+            succeeded += run_batch_bucket(pipe, jobs, output_dir, results, guidance_schedule)
+    
+    elapsed = time.perf_counter() - run_start
+    print(f"✅ Batch complete: {succeeded}/{total} jobs succeeded in {elapsed:.1f}s")
+    print(f"📄 Results saved: {results_file}")
+    return succeeded
+
 def main():
     parser = argparse.ArgumentParser(description='Generate Battle-Eternal style images with Anything V5')
     parser.add_argument('--prompt', '-p', type=str, help='Text prompt for image generation')
@@ -74,13 +306,52 @@ def main():
     parser.add_argument('--seed', type=int, help='Random seed for reproducible results')
     parser.add_argument('--interactive', '-i', action='store_true', help='Interactive mode')
     parser.add_argument('--battle-eternal', '-be', action='store_true', help='Use Battle-Eternal optimized settings')
+    parser.add_argument('--cfg-cutoff', type=float, default=0.0,
+                        help='Fraction of final steps run without full CFG (0 = off)')
+    parser.add_argument('--cfg-mode', type=str, default='truncate', choices=CFG_MODES,
+                        help='After the cutoff: truncate drops CFG, reuse reuses the last unconditional prediction')
+    parser.add_argument('--guidance-end', type=float, help='Guidance scale at the last step (enables a per-step guidance curve)')
+    parser.add_argument('--guidance-curve', type=str, default='linear', choices=GUIDANCE_CURVES,
+                        help='Shape of the guidance curve from --guidance to --guidance-end')
+    parser.add_argument('--tome-ratio', type=float, default=0.0,
+                        help='Token merging ratio for UNet self-attention, e.g. 0.5 (0 = off)')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                        help='Inference backend (onnx runs on CPU through ONNX Runtime)')
+    parser.add_argument('--onnx-path', type=str, default=ONNX_PATH, help='Cached ONNX export used by --backend onnx')
+    parser.add_argument('--profile', action='store_true', help='Record per-stage timings and export a Chrome trace')
+    parser.add_argument('--profile-output', type=str, help='Chrome trace path (default output/profile_<timestamp>.json)')
+    parser.add_argument('--torch-profiler', action='store_true', help='With --profile, also record operator-level torch profiler data')
+    parser.add_argument('--batch-file', type=str, help='JSONL file of jobs to generate (one JSON object per line)')
+    parser.add_argument('--batch-size', type=int, default=4, help='Max images per pipeline call in batch mode')
+    parser.add_argument('--results-file', type=str, help='Where to write per-job batch results (JSONL)')
     
     args = parser.parse_args()
     
+    try:
+        guidance_schedule = GuidanceSchedule(args.cfg_cutoff, args.cfg_mode, args.guidance_end, args.guidance_curve)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.batch_file and not os.path.exists(args.batch_file):
+        print(f"❌ Error: batch file not found: {args.batch_file}")
+        return
+    
+    if args.profile:
+        trace_path = args.profile_output or f"output/profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        PROFILER.start(trace_path, torch_profiler=args.torch_profiler)
+    
     # Setup the Anything V5 pipeline
-    pipe = setup_anything_v5_pipeline()
+    with span("model_load", backend=args.backend):
+        if args.backend == 'onnx':
+            pipe = setup_onnx_pipeline(args.onnx_path)
+        else:
+            pipe = setup_anything_v5_pipeline()
     if pipe is None:
         return
+    PROFILER.instrument_pipeline(pipe)
+    
+    if args.tome_ratio > 0:
+        apply_token_merging(pipe, args.tome_ratio)
     
     # Battle-Eternal optimized settings
     if args.battle_eternal:
@@ -93,7 +364,27 @@ def main():
     # Create output directory
     os.makedirs("output", exist_ok=True)
     
-    if args.interactive or not args.prompt:
+    if args.batch_file:
+        # Batch mode: CLI settings act as defaults for fields a job leaves out
+        defaults = {
+            "negative": args.negative,
+            "seed": args.seed,
+            "steps": args.steps,
+            "guidance": args.guidance,
+            "width": args.width,
+            "height": args.height,
+        }
+        run_batch_file(
+            pipe,
+            args.batch_file,
+            defaults,
+            output_dir="output",
+            results_file=args.results_file,
+            batch_size=args.batch_size,
+            guidance_schedule=guidance_schedule
+        )
+    
+    elif args.interactive or not args.prompt:
         # Interactive mode with Battle-Eternal examples
         print("\n🎭 Welcome to Battle-Eternal AI Art Generation with Anything V5!")
         print("Perfect for anime/light novel style illustrations")
@@ -144,7 +435,8 @@ def main():
                     guidance=args.guidance,
                     width=args.width,
                     height=args.height,
-                    seed=args.seed
+                    seed=args.seed,
+                    guidance_schedule=guidance_schedule
                 )
                 
                 # Save image
@@ -170,7 +462,8 @@ def main():
             guidance=args.guidance,
             width=args.width,
             height=args.height,
-            seed=args.seed
+            seed=args.seed,
+            guidance_schedule=guidance_schedule
         )
         
         filename = f"output/battle_eternal_anything_v5_{timestamp}.png"
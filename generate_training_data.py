@@ -10,10 +10,13 @@ outfit, and lighting to ensure good training data diversity.
 import argparse
 import os
 import torch
-from diffusers import StableDiffusionPipeline
+from diffusers import OnnxStableDiffusionImg2ImgPipeline, StableDiffusionImg2ImgPipeline, StableDiffusionPipeline
 from datetime import datetime
 import random
 import json
+from guidance import CFG_MODES, GUIDANCE_CURVES, GuidanceSchedule
+from onnx_backend import ONNX_PATH, is_onnx_pipeline, seeded_kwargs, setup_onnx_pipeline
+from profiling import PROFILER, span
 
 # Character-specific prompt templates
 CHARACTER_TEMPLATES = {
@@ -114,6 +117,9 @@ NEGATIVE_PROMPTS = [
     "multiple people, crowd, group, extra person, background characters, text, watermark, signature, artist name, low quality, blurry"
 ]
 
+# Denoising steps per image, faster than the generator's default for training data
+TRAINING_STEPS = 25
+
 def setup_pipeline():
     """Initialize the Anything V5 pipeline"""
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -143,6 +149,12 @@ def setup_pipeline():
     print("✅ Pipeline ready for training data generation!")
     return pipe
 
+def setup_img2img_pipeline(pipe):
+    """Build an img2img pipeline that shares the loaded model components"""
+    if is_onnx_pipeline(pipe):
+        return OnnxStableDiffusionImg2ImgPipeline(**pipe.components, requires_safety_checker=False)
+    return StableDiffusionImg2ImgPipeline(**pipe.components, requires_safety_checker=False)
+
 def generate_character_prompt(character, variation_index):
     """Generate a complete prompt for a character variation"""
     if character not in CHARACTER_TEMPLATES:
@@ -159,8 +171,20 @@ def generate_character_prompt(character, variation_index):
     full_prompt = f"{base}, {variation}, {quality}"
     return full_prompt
 
-def generate_training_images(pipe, character, count, output_dir, seed_base=None):
-    """Generate training images for a character"""
+def generate_training_images(pipe, character, count, output_dir, seed_base=None, anchors=0, strength=0.45,
+                             guidance_schedule=None):
+    """Generate training images for a character
+
+    With anchors > 0 only the first `anchors` images are full txt2img
+    generations. Every other image is an img2img variation of anchor
+    (i % anchors), which runs only int(steps * strength) denoising steps and
+    keeps the character's identity closer to its anchor.
+    
+    A guidance_schedule can cut CFG work on the late steps of every image.
+    """
+    
+    if guidance_schedule is None:
+        guidance_schedule = GuidanceSchedule()
     
     # Create character directory
     char_dir = os.path.join(output_dir, character)
@@ -178,7 +202,18 @@ def generate_training_images(pipe, character, count, output_dir, seed_base=None)
         "images": []
     }
     
+    steps = TRAINING_STEPS
+    anchors = min(anchors, count)
+    img2img_pipe = PROFILER.instrument_pipeline(setup_img2img_pipeline(pipe)) if anchors else None
+    anchor_images = {}
+    if anchors:
+        metadata["variation_mode"] = {"anchors": anchors, "strength": strength}
+        print(f"⚓ Using {anchors} anchor image(s), img2img variations at strength {strength}")
+    
     successful_generations = 0
+    unet_steps = 0
+    unet_evals = 0
+    unet_evals_saved = 0
     
     for i in range(count):
         try:
@@ -195,19 +230,39 @@ def generate_training_images(pipe, character, count, output_dir, seed_base=None)
                 seed = random.randint(0, 999999)
                 generator = torch.Generator().manual_seed(seed)
             
+            anchor_index = i % anchors if anchors else None
+            anchor = anchor_images.get(anchor_index) if i >= anchors else None
+            
             print(f"  🖼️  Generating image {i+1}/{count}: {prompt[:60]}...")
             
             # Generate image
-            with torch.no_grad():
-                result = pipe(
-                    prompt,
-                    negative_prompt=negative_prompt,
-                    num_inference_steps=25,  # Faster for training data
-                    guidance_scale=8.0,
-                    height=512,
-                    width=512,
-                    generator=generator
-                )
+            with torch.no_grad(), span("generate", character=character, index=i), \
+                    guidance_schedule.apply(pipe if anchor is None else img2img_pipe, 8.0) as schedule_kwargs:
+                if anchor is None:
+                    # Full txt2img; also the fallback when an anchor failed
+                    result = pipe(
+                        prompt,
+                        negative_prompt=negative_prompt,
+                        num_inference_steps=steps,
+                        guidance_scale=8.0,
+                        height=512,
+                        width=512,
+                        **seeded_kwargs(pipe, generator, 512, 512),
+                        **schedule_kwargs
+                    )
+                    steps_run = steps
+                else:
+                    result = img2img_pipe(
+                        prompt,
+                        image=anchor["image"],
+                        strength=strength,
+                        negative_prompt=negative_prompt,
+                        num_inference_steps=steps,
+                        guidance_scale=8.0,
+                        **seeded_kwargs(img2img_pipe, generator, 512, 512),
+                        **schedule_kwargs
+                    )
+                    steps_run = int(steps * strength)
             
             # Save image
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -223,15 +278,30 @@ def generate_training_images(pipe, character, count, output_dir, seed_base=None)
                 f.write(training_caption)
             
             # Add to metadata
-            metadata["images"].append({
+            image_metadata = {
                 "filename": filename,
                 "caption_file": os.path.basename(caption_path),
                 "prompt": prompt,
                 "negative_prompt": negative_prompt,
                 "seed": seed,
-                "variation_index": i
-            })
+                "variation_index": i,
+                "steps": steps_run
+            }
+            if guidance_schedule.steps:
+                image_metadata["unet_evals"] = guidance_schedule.unet_evals
+                unet_evals += guidance_schedule.unet_evals
+                unet_evals_saved += guidance_schedule.unet_evals_saved
+            if anchors:
+                if anchor is not None:
+                    image_metadata.update(mode="img2img", anchor=anchor["filename"], strength=strength)
+                else:
+                    image_metadata["mode"] = "anchor" if i < anchors else "txt2img"
+            metadata["images"].append(image_metadata)
             
+            if i < anchors:
+                anchor_images[anchor_index] = {"image": result.images[0], "filename": filename}
+            
+            unet_steps += steps_run
             successful_generations += 1
             print(f"    ✅ Saved: {filename}")
             
@@ -239,6 +309,23 @@ def generate_training_images(pipe, character, count, output_dir, seed_base=None)
             print(f"    ❌ Error generating image {i+1}: {e}")
             continue
     
+    if anchors:
+        metadata["variation_mode"]["unet_steps"] = unet_steps
+        metadata["variation_mode"]["txt2img_unet_steps"] = successful_generations * steps
+        print(f"⚡ UNet steps: {unet_steps} (full txt2img would be {successful_generations * steps})")
+    
+    if guidance_schedule.enabled:
+        metadata["guidance_schedule"] = {
+            "cfg_cutoff": guidance_schedule.cutoff,
+            "cfg_mode": guidance_schedule.mode,
+            "guidance_end": guidance_schedule.guidance_end,
+            "guidance_curve": guidance_schedule.curve,
+            "unet_evals": unet_evals,
+            "unet_evals_saved": unet_evals_saved
+        }
+        if successful_generations:
+            print(f"⚡ UNet evaluations saved by guidance schedule: {unet_evals_saved / successful_generations:.1f} per image")
+    
     # Save metadata
     metadata_path = os.path.join(char_dir, "training_metadata.json")
     with open(metadata_path, 'w', encoding='utf-8') as f:
@@ -260,13 +347,52 @@ def main():
                         help='Output directory for training images')
     parser.add_argument('--seed_base', '-s', type=int, help='Base seed for reproducible generation')
     parser.add_argument('--all', action='store_true', help='Generate for all characters')
+    parser.add_argument('--anchors', type=int, default=0,
+                        help='Full txt2img anchors per character; other images become img2img variations (0 = off)')
+    parser.add_argument('--strength', type=float, default=0.45,
+                        help='img2img strength for variations (fraction of denoising steps run)')
+    parser.add_argument('--profile', action='store_true', help='Record per-stage timings and export a Chrome trace')
+    parser.add_argument('--profile-output', type=str, help='Chrome trace path (default output/profile_<timestamp>.json)')
+    parser.add_argument('--torch-profiler', action='store_true', help='With --profile, also record operator-level torch profiler data')
+    parser.add_argument('--cfg-cutoff', type=float, default=0.0,
+                        help='Fraction of final steps run without full CFG (0 = off)')
+    parser.add_argument('--cfg-mode', type=str, default='truncate', choices=CFG_MODES,
+                        help='After the cutoff: truncate drops CFG, reuse reuses the last unconditional prediction')
+    parser.add_argument('--guidance-end', type=float, help='Guidance scale at the last step (enables a per-step guidance curve)')
+    parser.add_argument('--guidance-curve', type=str, default='linear', choices=GUIDANCE_CURVES,
+                        help='Shape of the guidance curve from --guidance to --guidance-end')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                        help='Inference backend (onnx runs on CPU through ONNX Runtime)')
+    parser.add_argument('--onnx-path', type=str, default=ONNX_PATH, help='Cached ONNX export used by --backend onnx')
     
     args = parser.parse_args()
     
+    if args.anchors < 0:
+        parser.error(f"--anchors must be 0 or more, got {args.anchors}")
+    if not 0 < args.strength <= 1:
+        parser.error(f"--strength must be in (0, 1], got {args.strength}")
+    if int(TRAINING_STEPS * args.strength) < 1:
+        parser.error(f"--strength {args.strength} runs no denoising steps at {TRAINING_STEPS} steps, "
+                     f"use at least {1 / TRAINING_STEPS}")
+    
+    try:
+        guidance_schedule = GuidanceSchedule(args.cfg_cutoff, args.cfg_mode, args.guidance_end, args.guidance_curve)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.profile:
+        trace_path = args.profile_output or f"output/profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        PROFILER.start(trace_path, torch_profiler=args.torch_profiler)
+    
     # Setup pipeline
-    pipe = setup_pipeline()
+    with span("model_load", backend=args.backend):
+        if args.backend == 'onnx':
+            pipe = setup_onnx_pipeline(args.onnx_path)
+        else:
+            pipe = setup_pipeline()
     if pipe is None:
         return
+    PROFILER.instrument_pipeline(pipe)
     
     # Create output directory
     os.makedirs(args.output_dir, exist_ok=True)
@@ -279,7 +405,9 @@ def main():
         for char in characters:
             print(f"\n🎭 Starting generation for {char}")
             generated = generate_training_images(
-                pipe, char, args.count, args.output_dir, args.seed_base
+                pipe, char, args.count, args.output_dir, args.seed_base,
+                anchors=args.anchors, strength=args.strength,
+                guidance_schedule=guidance_schedule
             )
             total_generated += generated
         
@@ -289,7 +417,9 @@ def main():
         # Generate for single character
         print(f"\n🎭 Starting generation for {args.character}")
         generated = generate_training_images(
-            pipe, args.character, args.count, args.output_dir, args.seed_base
+            pipe, args.character, args.count, args.output_dir, args.seed_base,
+            anchors=args.anchors, strength=args.strength,
+            guidance_schedule=guidance_schedule
         )
         print(f"\n🎉 Training images generated: {generated}")
     
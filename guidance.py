@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Battle-Eternal Guidance Schedules
+
+Classifier-free guidance (CFG) runs the UNet on a conditional and an
+unconditional copy of every latent, doubling the work per step. Late steps
+barely change the image, so a GuidanceSchedule can:
+
+- truncate: drop the unconditional branch for the last fraction of steps
+- reuse: keep guiding, but reuse the last unconditional prediction instead
+  of recomputing it
+- curve: vary the guidance scale per step (linear or cosine towards an end value)
+
+It hooks into the torch pipeline's `callback_on_step_end`, so it works for
+both txt2img and img2img. ONNX pipelines have no step callback and ignore it.
+"""
+
+import math
+from contextlib import contextmanager
+
+import torch
+
+from onnx_backend import is_onnx_pipeline
+
+CFG_MODES = ["truncate", "reuse"]
+GUIDANCE_CURVES = ["linear", "cosine"]
+
+class GuidanceSchedule:
+    """Per-step CFG control for one pipeline call at a time"""
+
+    def __init__(self, cutoff=0.0, mode="truncate", guidance_end=None, curve="linear"):
+        if not 0.0 <= cutoff <= 1.0:
+            raise ValueError(f"cutoff must be between 0 and 1, got {cutoff}")
+        if mode not in CFG_MODES:
+            raise ValueError(f"Unknown CFG mode: {mode}")
+        if curve not in GUIDANCE_CURVES:
+            raise ValueError(f"Unknown guidance curve: {curve}")
+
+        self.cutoff = cutoff
+        self.mode = mode
+        self.guidance_end = guidance_end
+        self.curve = curve
+
+        # Stats for the most recent call, per image
+        self.steps = 0
+        self.unet_evals = 0
+        self.full_cfg_evals = 0
+
+    @property
+    def enabled(self):
+        return self.cutoff > 0 or self.guidance_end is not None
+
+    @property
+    def unet_evals_saved(self):
+        return self.full_cfg_evals - self.unet_evals
+
+    def guidance_at(self, guidance, step, total_steps):
+        """Guidance scale for a step under the configured curve"""
+        if self.guidance_end is None or total_steps < 2:
+            return guidance
+        t = step / (total_steps - 1)
+        if self.curve == "cosine":
+            return self.guidance_end + (guidance - self.guidance_end) * (1 + math.cos(math.pi * t)) / 2
+        return guidance + (self.guidance_end - guidance) * t
+
+    def full_cfg_steps(self, total_steps):
+        """Number of leading steps that run both UNet branches"""
+        return math.ceil(total_steps * (1 - self.cutoff))
+
+    @contextmanager
+    def apply(self, pipe, guidance):
+        """Yield extra pipeline kwargs that run this schedule during the call"""
+        self.steps = 0
+        self.unet_evals = 0
+        self.full_cfg_evals = 0
+        if not self.enabled:
+            yield {}
+            return
+        if is_onnx_pipeline(pipe):
+            print("⚠️  Guidance schedules need the torch backend, running full CFG")
+            yield {}
+            return
+
+        state = {"cfg": guidance > 1, "reuse": False, "uncond": None}
+
+        def on_step_end(pipeline, step, timestep, callback_kwargs):
+            total_steps = pipeline.num_timesteps
+            self.steps += 1
+            self.unet_evals += 2 if state["cfg"] and not state["reuse"] else 1
+            self.full_cfg_evals += 2 if guidance > 1 else 1
+
+            next_step = step + 1
+            if not state["cfg"] or next_step >= total_steps:
+                return callback_kwargs
+
+            next_guidance = self.guidance_at(guidance, next_step, total_steps)
+            past_cutoff = next_step >= self.full_cfg_steps(total_steps)
+
+            if next_guidance <= 1 or (past_cutoff and self.mode == "truncate"):
+                # Drop the unconditional half for the rest of the run
+                state["cfg"] = False
+                state["reuse"] = False
+                pipeline._guidance_scale = 0.0
+                callback_kwargs["prompt_embeds"] = callback_kwargs["prompt_embeds"].chunk(2)[-1]
+            else:
+                state["reuse"] = past_cutoff
+                pipeline._guidance_scale = next_guidance
+            return callback_kwargs
+
+        unet = pipe.unet
+        had_forward = "forward" in unet.__dict__
+        original_forward = unet.forward
+
+        def forward(sample, timestep, *args, **kwargs):
+            if not (state["reuse"] and state["cfg"]):
+                output = original_forward(sample, timestep, *args, **kwargs)
+                if state["cfg"]:
+                    state["uncond"] = output[0].chunk(2)[0]
+                return output
+
+            # Only the conditional half is evaluated; the cached
+            # unconditional prediction stands in for the other half
+            half = sample.shape[0] // 2
+            kwargs["encoder_hidden_states"] = kwargs["encoder_hidden_states"][half:]
+            cond = original_forward(sample[half:], timestep, *args, **kwargs)[0]
+            return (torch.cat([state["uncond"], cond]),)
+
+        if self.mode == "reuse":
+            unet.forward = forward
+        try:
+            yield {
+                "callback_on_step_end": on_step_end,
+                "callback_on_step_end_tensor_inputs": ["prompt_embeds"],
+            }
+        finally:
+            if self.mode == "reuse":
+                if had_forward:
+                    unet.forward = original_forward
+                else:
+                    del unet.forward
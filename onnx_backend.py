@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Battle-Eternal ONNX Runtime Backend
+
+Exports the local Anything V5 model (text encoder, UNet and VAE) to ONNX,
+applies ONNX Runtime graph optimizations once and caches the result, so the
+generator scripts can run inference on CPU with `--backend onnx` instead of
+eager PyTorch.
+
+    python onnx_backend.py export
+    python onnx_backend.py benchmark --seeds 1 2 3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+from diffusers import (
+    OnnxRuntimeModel,
+    OnnxStableDiffusionImg2ImgPipeline,
+    OnnxStableDiffusionPipeline,
+    StableDiffusionPipeline,
+)
+
+MODEL_PATH = "models/checkpoints/anything-v5"
+ONNX_PATH = "models/onnx/anything-v5"
+ONNX_OPSET = 14
+ONNX_MODELS = ["text_encoder", "unet", "vae_encoder", "vae_decoder"]
+# Everything an export writes into onnx_path, and nothing else
+EXPORT_ENTRIES = ONNX_MODELS + ["raw", "tokenizer", "scheduler", "model_index.json", "export_info.json"]
+
+# Latent layout used by Stable Diffusion 1.x checkpoints like Anything V5
+LATENT_CHANNELS = 4
+VAE_SCALE_FACTOR = 8
+
+def import_onnxruntime():
+    """Import onnxruntime, with a friendly message when it is missing"""
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("onnxruntime is required for the ONNX backend: pip install onnxruntime")
+    return onnxruntime
+
+def is_onnx_pipeline(pipe):
+    """True when the pipeline runs through ONNX Runtime"""
+    return isinstance(pipe, (OnnxStableDiffusionPipeline, OnnxStableDiffusionImg2ImgPipeline))
+
+def seeded_kwargs(pipe, generator, height, width):
+    """Pipeline kwargs that carry the seed for either backend.
+
+    The ONNX pipeline draws noise from numpy, so a seed would give a different
+    image than PyTorch. Instead the initial latents are drawn from the torch
+    generator(s) exactly like StableDiffusionPipeline does and passed in.
+    ONNX img2img takes no latents, so it gets a numpy generator with the
+    same seed (reproducible, but not pixel-identical to PyTorch).
+    """
+    if not is_onnx_pipeline(pipe):
+        return {"generator": generator}
+    if generator is None:
+        return {}
+    if isinstance(pipe, OnnxStableDiffusionImg2ImgPipeline):
+        return {"generator": np.random.RandomState(generator.initial_seed())}
+
+    generators = generator if isinstance(generator, list) else [generator]
+    shape = (1, LATENT_CHANNELS, height // VAE_SCALE_FACTOR, width // VAE_SCALE_FACTOR)
+    latents = torch.cat([torch.randn(shape, generator=g, dtype=torch.float32) for g in generators])
+    return {"latents": latents.numpy()}
+
+def export_exists(onnx_path=ONNX_PATH):
+    """Check for a complete cached export"""
+    return all(os.path.exists(os.path.join(onnx_path, name))
+               for name in ["model_index.json", "export_info.json"])
+
+def clear_onnx_export(onnx_path=ONNX_PATH):
+    """Remove a previous (possibly interrupted) export before re-exporting.
+
+    Only entries the export writes are deleted, and a directory that doesn't
+    look like an export is left alone, so a mistyped --onnx-path can't wipe
+    unrelated files.
+    """
+    if not os.path.exists(onnx_path):
+        return True
+    if not os.path.isdir(onnx_path):
+        print(f"❌ Error: {onnx_path} is not a directory")
+        return False
+
+    entries = os.listdir(onnx_path)
+    unknown = sorted(set(entries) - set(EXPORT_ENTRIES))
+    is_export = "export_info.json" in entries or "raw" in entries or any(
+        os.path.exists(os.path.join(onnx_path, name, "model.onnx")) for name in ONNX_MODELS)
+    if unknown or (entries and not is_export):
+        print(f"❌ Error: {onnx_path} doesn't look like an ONNX export, refusing to overwrite it")
+        if unknown:
+            print(f"Unexpected entries: {', '.join(unknown)}")
+        return False
+
+    for name in entries:
+        path = os.path.join(onnx_path, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return True
+
+def onnx_export(model, model_args, output_path, input_names, output_names, dynamic_axes, opset=ONNX_OPSET):
+    """Export one torch module to an ONNX file"""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    torch.onnx.export(
+        model,
+        model_args,
+        f=output_path,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        do_constant_folding=True,
+        opset_version=opset
+    )
+
+def optimize_onnx_model(raw_path, output_path):
+    """Run ONNX Runtime's offline graph optimizations and save the result.
+
+    Extended (not "all") is the highest level that stays portable across
+    machines; layout optimizations are applied again when the session loads.
+    Weights go to weights.pb so the >2GB UNet stays loadable.
+    """
+    ort = import_onnxruntime()
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = output_path
+    options.add_session_config_entry("session.optimized_model_external_initializers_file_name", "weights.pb")
+    options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+    ort.InferenceSession(raw_path, options, providers=["CPUExecutionProvider"])
+
+def export_anything_v5_onnx(model_path=MODEL_PATH, onnx_path=ONNX_PATH, opset=ONNX_OPSET, force=False):
+    """Export Anything V5 to ONNX and cache the optimized models"""
+    if export_exists(onnx_path) and not force:
+        print(f"✅ Using cached ONNX export: {onnx_path}")
+        return True
+
+    if not os.path.exists(model_path):
+        print(f"❌ Error: Anything V5 model not found at {model_path}")
+        return False
+
+    ort = import_onnxruntime()
+
+    if not clear_onnx_export(onnx_path):
+        return False
+
+    print("📦 Loading Anything V5 model for ONNX export...")
+    pipe = StableDiffusionPipeline.from_pretrained(
+        model_path,
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        requires_safety_checker=False,
+        local_files_only=True
+    )
+
+    raw_path = os.path.join(onnx_path, "raw")
+
+    with torch.no_grad():
+        # Text encoder
+        print("🔄 Exporting text encoder...")
+        num_tokens = pipe.text_encoder.config.max_position_embeddings
+        text_hidden_size = pipe.text_encoder.config.hidden_size
+        text_input = pipe.tokenizer(
+            "A sample prompt",
+            padding="max_length",
+            max_length=pipe.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt"
+        )
+        onnx_export(
+            pipe.text_encoder,
+            model_args=(text_input.input_ids.to(torch.int32),),
+            output_path=os.path.join(raw_path, "text_encoder", "model.onnx"),
+            input_names=["input_ids"],
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}},
+            opset=opset
+        )
+
+        # UNet
+        print("🔄 Exporting UNet...")
+        unet_in_channels = pipe.unet.config.in_channels
+        unet_sample_size = pipe.unet.config.sample_size
+        onnx_export(
+            pipe.unet,
+            model_args=(
+                torch.randn(2, unet_in_channels, unet_sample_size, unet_sample_size),
+                torch.randn(2),
+                torch.randn(2, num_tokens, text_hidden_size),
+                False
+            ),
+            output_path=os.path.join(raw_path, "unet", "model.onnx"),
+            input_names=["sample", "timestep", "encoder_hidden_states", "return_dict"],
+            output_names=["out_sample"],
+            dynamic_axes={
+                "sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
+                "timestep": {0: "batch"},
+                "encoder_hidden_states": {0: "batch", 1: "sequence"},
+            },
+            opset=opset
+        )
+
+        # VAE encoder (needed by the ONNX pipeline and img2img)
+        print("🔄 Exporting VAE encoder...")
+        vae = pipe.vae
+        vae_in_channels = vae.config.in_channels
+        vae_sample_size = vae.config.sample_size
+        vae.forward = lambda sample, return_dict: vae.encode(sample, return_dict)[0].sample()
+        onnx_export(
+            vae,
+            model_args=(torch.randn(1, vae_in_channels, vae_sample_size, vae_sample_size), False),
+            output_path=os.path.join(raw_path, "vae_encoder", "model.onnx"),
+            input_names=["sample", "return_dict"],
+            output_names=["latent_sample"],
+            dynamic_axes={"sample": {0: "batch", 1: "channels", 2: "height", 3: "width"}},
+            opset=opset
+        )
+
+        # VAE decoder
+        print("🔄 Exporting VAE decoder...")
+        vae.forward = vae.decode
+        onnx_export(
+            vae,
+            model_args=(torch.randn(1, vae.config.latent_channels, unet_sample_size, unet_sample_size), False),
+            output_path=os.path.join(raw_path, "vae_decoder", "model.onnx"),
+            input_names=["latent_sample", "return_dict"],
+            output_names=["sample"],
+            dynamic_axes={"latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"}},
+            opset=opset
+        )
+
+    for name in ONNX_MODELS:
+        print(f"⚙️  Optimizing {name} graph...")
+        optimize_onnx_model(
+            os.path.join(raw_path, name, "model.onnx"),
+            os.path.join(onnx_path, name, "model.onnx")
+        )
+    shutil.rmtree(raw_path)
+
+    onnx_pipe = OnnxStableDiffusionPipeline(
+        vae_encoder=OnnxRuntimeModel.from_pretrained(os.path.join(onnx_path, "vae_encoder")),
+        vae_decoder=OnnxRuntimeModel.from_pretrained(os.path.join(onnx_path, "vae_decoder")),
+        text_encoder=OnnxRuntimeModel.from_pretrained(os.path.join(onnx_path, "text_encoder")),
+        tokenizer=pipe.tokenizer,
+        unet=OnnxRuntimeModel.from_pretrained(os.path.join(onnx_path, "unet")),
+        scheduler=pipe.scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    onnx_pipe.save_pretrained(onnx_path)
+
+    # Written last, so an interrupted export is never mistaken for a cached one
+    export_info = {
+        "source": model_path,
+        "opset": opset,
+        "torch_version": torch.__version__,
+        "onnxruntime_version": ort.__version__,
+        "export_date": datetime.now().isoformat(),
+    }
+    with open(os.path.join(onnx_path, "export_info.json"), 'w', encoding='utf-8') as f:
+        json.dump(export_info, f, indent=2)
+
+    print(f"✅ ONNX export saved: {onnx_path}")
+    return True
+
+def setup_onnx_pipeline(onnx_path=ONNX_PATH, threads=None):
+    """Load the cached ONNX export on the CPU execution provider"""
+    print("💻 Using device: cpu (ONNX Runtime)")
+
+    if not export_exists(onnx_path):
+        print(f"❌ Error: ONNX export not found at {onnx_path}")
+        print("Run 'python onnx_backend.py export' first.")
+        return None
+
+    ort = import_onnxruntime()
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+
+    print("📦 Loading Anything V5 ONNX model...")
+    pipe = OnnxStableDiffusionPipeline.from_pretrained(
+        onnx_path,
+        provider="CPUExecutionProvider",
+        sess_options=options,
+        safety_checker=None,
+        requires_safety_checker=False,
+        local_files_only=True
+    )
+
+    print("✅ Anything V5 ONNX model loaded and ready!")
+    return pipe
+
+def benchmark_backends(prompt, seeds, steps=25, guidance=8.0, width=512, height=768, tolerance=2.0,
+                       onnx_path=ONNX_PATH, output_dir="output/onnx_benchmark"):
+    """Check ONNX output against PyTorch for each seed and time both backends.
+
+    An image passes when its mean absolute pixel difference (0-255 scale) is
+    within tolerance. Returns True if every seed passes.
+    """
+    from generate_anything_v5 import build_negative_prompt, run_seeded, setup_anything_v5_pipeline
+
+    torch_pipe = setup_anything_v5_pipeline(device="cpu")
+    onnx_pipe = setup_onnx_pipeline(onnx_path)
+    if torch_pipe is None or onnx_pipe is None:
+        return False
+
+    os.makedirs(output_dir, exist_ok=True)
+    negative_prompt = build_negative_prompt()
+
+    # One untimed run each so session/kernel warm-up doesn't skew the first seed
+    print("🔥 Warming up both backends...")
+    run_seeded(torch_pipe, prompt, negative_prompt, seeds[0], 2, guidance, width, height)
+    run_seeded(onnx_pipe, prompt, negative_prompt, seeds[0], 2, guidance, width, height)
+
+    rows = []
+    for seed in seeds:
+        print(f"🎨 Seed {seed}: PyTorch...")
+        torch_image, torch_seconds = run_seeded(torch_pipe, prompt, negative_prompt, seed, steps, guidance, width, height)
+        print(f"🎨 Seed {seed}: ONNX Runtime...")
+        onnx_image, onnx_seconds = run_seeded(onnx_pipe, prompt, negative_prompt, seed, steps, guidance, width, height)
+
+        torch_image.save(os.path.join(output_dir, f"seed_{seed}_torch.png"))
+        onnx_image.save(os.path.join(output_dir, f"seed_{seed}_onnx.png"))
+
+        diff = np.abs(np.asarray(torch_image, dtype=np.float32) - np.asarray(onnx_image, dtype=np.float32))
+        rows.append({
+            "seed": seed,
+            "torch_seconds": round(torch_seconds, 2),
+            "onnx_seconds": round(onnx_seconds, 2),
+            "speedup": round(torch_seconds / onnx_seconds, 2),
+            "mean_abs_diff": round(float(diff.mean()), 3),
+            "max_abs_diff": round(float(diff.max()), 1),
+            "passed": bool(diff.mean() <= tolerance),
+        })
+
+    print(f"\n📊 PyTorch vs ONNX Runtime ({width}x{height}, {steps} steps, CPU)")
+    print(f"{'seed':>8} {'torch s':>9} {'onnx s':>9} {'speedup':>8} {'mean diff':>10} {'max diff':>9}  result")
+    for row in rows:
+        result = "✅" if row["passed"] else "❌"
+        print(f"{row['seed']:>8} {row['torch_seconds']:>9} {row['onnx_seconds']:>9} {row['speedup']:>7}x "
+              f"{row['mean_abs_diff']:>10} {row['max_abs_diff']:>9}  {result}")
+
+    report_path = os.path.join(output_dir, "benchmark.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"prompt": prompt, "steps": steps, "guidance": guidance, "width": width,
+                   "height": height, "tolerance": tolerance, "results": rows}, f, indent=2)
+    print(f"📄 Report saved: {report_path}")
+
+    return all(row["passed"] for row in rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and benchmark the Anything V5 ONNX Runtime backend')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export Anything V5 to optimized ONNX models')
+    export_parser.add_argument('--model-path', type=str, default=MODEL_PATH, help='Anything V5 diffusers folder')
+    export_parser.add_argument('--onnx-path', type=str, default=ONNX_PATH, help='Where to cache the ONNX export')
+    export_parser.add_argument('--opset', type=int, default=ONNX_OPSET, help='ONNX opset version')
+    export_parser.add_argument('--force', action='store_true', help='Re-export even if a cached export exists')
+
+    bench_parser = subparsers.add_parser('benchmark', help='Compare ONNX Runtime against PyTorch on CPU')
+    bench_parser.add_argument('--prompt', '-p', type=str,
+                              default="anime style portrait of Alexander, blonde hair, blue eyes, glasses, red hoodie, detailed art",
+                              help='Prompt used for every seed')
+    bench_parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2, 3], help='Seeds to compare')
+    bench_parser.add_argument('--steps', '-s', type=int, default=25, help='Number of inference steps')
+    bench_parser.add_argument('--guidance', '-g', type=float, default=8.0, help='Guidance scale')
+    bench_parser.add_argument('--width', '-w', type=int, default=512, help='Image width')
+    bench_parser.add_argument('--height', type=int, default=768, help='Image height')
+    bench_parser.add_argument('--tolerance', type=float, default=2.0, help='Max mean absolute pixel difference')
+    bench_parser.add_argument('--onnx-path', type=str, default=ONNX_PATH, help='Cached ONNX export to load')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_anything_v5_onnx(args.model_path, args.onnx_path, args.opset, args.force)
+    else:
+        passed = benchmark_backends(
+            args.prompt,
+            args.seeds,
+            steps=args.steps,
+            guidance=args.guidance,
+            width=args.width,
+            height=args.height,
+            tolerance=args.tolerance,
+            onnx_path=args.onnx_path
+        )
+        print("\n🎉 ONNX output matches PyTorch!" if passed else "\n⚠️  ONNX output differs from PyTorch beyond tolerance")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Battle-Eternal Hot-Path Profiling
+
+Records timed spans for model load, prompt encoding, every UNet call and
+scheduler step, VAE encode/decode, postprocessing and file I/O, then exports
+them as Chrome trace JSON (open in chrome://tracing or https://ui.perfetto.dev)
+and prints a summary table. Used by the generator scripts' `--profile` flag.
+
+Spans are cheap when profiling is off, so `span(...)` can stay in hot paths.
+The optional torch profiler only records the first few generations, so its
+memory stays bounded on long batch runs.
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from PIL import Image
+
+class Profiler:
+    """Collects spans and exports them as a Chrome trace"""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.perf_counter()
+        self.torch_profile = None
+        self.torch_generations = 0
+        self._lock = threading.Lock()
+
+    def start(self, trace_path, torch_profiler=False, torch_profiler_generations=3):
+        """Enable profiling; the trace is written when the process exits"""
+        self.enabled = True
+        self.events = []
+        self.origin = time.perf_counter()
+
+        # Every script saves through PIL, so this covers all image file I/O
+        self._wrap(Image.Image, "save", "image_save", "io")
+
+        if torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            # A profiler step ends whenever a "generate" span starts, so model
+            # load is the (discarded) warmup step and only the next few
+            # generations are recorded
+            self.torch_profile = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                schedule=torch.profiler.schedule(wait=0, warmup=1, active=torch_profiler_generations, repeat=1)
+            )
+            self.torch_profile.__enter__()
+
+        print(f"⏱️  Profiling enabled, trace will be saved to {trace_path}")
+        atexit.register(self.finish, trace_path)
+
+    @contextmanager
+    def span(self, name, category="pipeline", **args):
+        """Time a block of code as one complete trace event"""
+        if not self.enabled:
+            yield
+            return
+
+        if name == "generate" and self.torch_profile is not None:
+            self.torch_generations += 1
+            self.torch_profile.step()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+            }
+            if args:
+                event["args"] = args
+            with self._lock:
+                self.events.append(event)
+
+    def _wrap(self, obj, method, name, category):
+        """Replace obj.method with a version that records a span per call"""
+        original = getattr(obj, method, None)
+        if original is None or getattr(original, "_profiled", False):
+            return
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.span(name, category):
+                return original(*args, **kwargs)
+
+        timed._profiled = True
+        setattr(obj, method, timed)
+
+    def instrument_pipeline(self, pipe):
+        """Wrap the hot-path stages of a torch or ONNX Stable Diffusion pipeline.
+
+        Components shared between pipelines (e.g. the img2img pipeline built
+        from the txt2img one) are only wrapped once.
+        """
+        if not self.enabled:
+            return pipe
+
+        self._wrap(pipe, "encode_prompt", "tokenize_encode", "text")
+        self._wrap(pipe, "_encode_prompt", "tokenize_encode", "text")
+        self._wrap(pipe.scheduler, "step", "scheduler_step", "denoise")
+
+        if hasattr(pipe, "vae"):
+            self._wrap(pipe.unet, "forward", "unet", "denoise")
+            self._wrap(pipe.vae, "encode", "vae_encode", "vae")
+            self._wrap(pipe.vae, "decode", "vae_decode", "vae")
+            self._wrap(pipe, "run_safety_checker", "safety_check", "postprocess")
+            self._wrap(pipe.image_processor, "postprocess", "postprocess", "postprocess")
+        else:
+            # ONNX pipelines: time the ONNX Runtime sessions directly
+            self._wrap(pipe.unet.model, "run", "unet", "denoise")
+            self._wrap(pipe.vae_decoder.model, "run", "vae_decode", "vae")
+            if getattr(pipe, "vae_encoder", None) is not None:
+                self._wrap(pipe.vae_encoder.model, "run", "vae_encode", "vae")
+            self._wrap(pipe, "numpy_to_pil", "postprocess", "postprocess")
+
+        return pipe
+
+    def export_chrome_trace(self, trace_path):
+        """Write the recorded spans as Chrome trace JSON"""
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        metadata = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": "battle-eternal-ai"},
+        }]
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+
+    def print_summary(self):
+        """Print count, total, mean and max time per span name"""
+        wall_ms = (time.perf_counter() - self.origin) * 1000
+        stats = {}
+        for event in self.events:
+            stat = stats.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+            duration_ms = event["dur"] / 1000
+            stat["count"] += 1
+            stat["total"] += duration_ms
+            stat["max"] = max(stat["max"], duration_ms)
+
+        print(f"\n📊 Profile summary (wall time {wall_ms / 1000:.2f}s)")
+        print(f"{'span':<18} {'count':>7} {'total ms':>11} {'mean ms':>10} {'max ms':>10} {'% wall':>7}")
+        for name, stat in sorted(stats.items(), key=lambda item: item[1]["total"], reverse=True):
+            print(f"{name:<18} {stat['count']:>7} {stat['total']:>11.1f} {stat['total'] / stat['count']:>10.1f} "
+                  f"{stat['max']:>10.1f} {100 * stat['total'] / wall_ms:>6.1f}%")
+
+    def finish(self, trace_path):
+        """Stop profiling, export the trace(s) and print the summary"""
+        if not self.enabled:
+            return
+
+        self.print_summary()
+        self.export_chrome_trace(trace_path)
+        print(f"📄 Trace saved: {trace_path}")
+
+        if self.torch_profile is not None:
+            self.torch_profile.__exit__(None, None, None)
+            if not self.torch_generations:
+                print("⚠️  No generations ran, torch profiler has nothing to report")
+                self.torch_profile = None
+                self.enabled = False
+                return
+            sort_key = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+            print("\n🔬 Top operators (torch profiler)")
+            print(self.torch_profile.key_averages().table(sort_by=sort_key, row_limit=20))
+            torch_trace_path = os.path.splitext(trace_path)[0] + "_torch.json"
+            self.torch_profile.export_chrome_trace(torch_trace_path)
+            print(f"📄 Torch profiler trace saved: {torch_trace_path}")
+            self.torch_profile = None
+
+        self.enabled = False
+
+PROFILER = Profiler()
+span = PROFILER.span
@@ -0,0 +1,129 @@
+import json
+import os
+import tempfile
+
+import generate_anything_v5 as gen
+
+DEFAULTS = {"negative": "", "seed": None, "steps": 25, "guidance": 8.0, "width": 512, "height": 768}
+
+def write_jobs(directory, lines):
+    path = os.path.join(directory, "jobs.jsonl")
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+    return path
+
+def read_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+class StubImage:
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(b"png")
+
+def run_with_stub_buckets(directory, lines, **kwargs):
+    """Run run_batch_file with run_batch_bucket replaced by a recorder"""
+    flushed = []
+
+    def record_bucket(pipe, jobs, output_dir, results, guidance_schedule=None):
+        flushed.append([job["line"] for job in jobs])
+        return len(jobs)
+
+    original = gen.run_batch_bucket
+    gen.run_batch_bucket = record_bucket
+    try:
+        results_file = os.path.join(directory, "results.jsonl")
+        gen.run_batch_file(None, write_jobs(directory, lines), DEFAULTS, output_dir=os.path.join(directory, "output"),
+                           results_file=results_file, **kwargs)
+    finally:
+        gen.run_batch_bucket = original
+    return flushed, read_results(results_file)
+
+def test_iter_batch_jobs_reports_malformed_lines():
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_jobs(directory, [
+            "not json",
+            {"negative": "no prompt"},
+            {"prompt": 42},
+            {"prompt": "a", "output": 123},
+            {"prompt": "a", "seed": "abc"},
+            {"prompt": "a", "seed": "42"},
+            {"prompt": "b"},
+        ])
+        jobs = list(gen.iter_batch_jobs(path, DEFAULTS, "run1"))
+
+    errors = [line for line, job, error in jobs if error is not None]
+    assert errors == [1, 2, 3, 4, 5]
+    assert jobs[5][1]["seed"] == 42
+    assert jobs[6][1]["output"] == "batch_run1_000007.png"
+
+def test_resolve_output_path_rejects_escapes():
+    assert gen.resolve_output_path("output", "sub/a.png") == os.path.join("output", "sub", "a.png")
+    assert gen.resolve_output_path("output", "sub/../b.png") == os.path.join("output", "b.png")
+    for output in ["../x.png", "sub/../../x.png", os.path.abspath("x.png"), ".", ""]:
+        try:
+            gen.resolve_output_path("output", output)
+        except ValueError:
+            continue
+        raise AssertionError(f"{output!r} should be rejected")
+
+def test_bad_output_is_a_per_line_error():
+    with tempfile.TemporaryDirectory() as directory:
+        flushed, results = run_with_stub_buckets(directory, [
+            {"prompt": "a", "output": 123},
+            {"prompt": "b", "output": "../escape.png"},
+            {"prompt": "c"},
+        ], batch_size=4)
+
+    assert [(r["line"], r["status"]) for r in results] == [(1, "error"), (2, "error")]
+    assert flushed == [[3]]
+
+def test_buckets_flush_at_batch_size_and_when_pending_overflows():
+    small = {"prompt": "a", "width": 512, "height": 512}
+    large = {"prompt": "b", "width": 768, "height": 512}
+    other = {"prompt": "c", "width": 512, "height": 768}
+    with tempfile.TemporaryDirectory() as directory:
+        flushed, _ = run_with_stub_buckets(directory, [small, large, small, other], batch_size=2, max_pending=3)
+
+    # The small bucket flushes as soon as it holds batch_size jobs, the rest at the end
+    assert flushed == [[1, 3], [2], [4]]
+
+    with tempfile.TemporaryDirectory() as directory:
+        flushed, _ = run_with_stub_buckets(directory, [small, large, other, large], batch_size=4, max_pending=3)
+
+    # The 4th pending job overflows max_pending, so the fullest bucket goes first
+    assert flushed[0] == [2, 4]
+
+def test_duplicate_output_is_recorded_as_overwrite():
+    original = gen.generate_batch
+    gen.generate_batch = lambda pipe, jobs, guidance_schedule=None: [StubImage() for _ in jobs]
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            results_file = os.path.join(directory, "results.jsonl")
+            path = write_jobs(directory, [
+                {"prompt": "a", "output": "same.png"},
+                {"prompt": "b", "output": "same.png", "width": 768},
+            ])
+            gen.run_batch_file(None, path, DEFAULTS, output_dir=os.path.join(directory, "output"),
+                               results_file=results_file, batch_size=1)
+            results = read_results(results_file)
+    finally:
+        gen.generate_batch = original
+
+    assert [r["status"] for r in results] == ["ok", "ok"]
+    assert "overwrote" not in results[0]
+    assert results[1]["overwrote"] is True
+
+if __name__ == "__main__":
+    tests = [
+        test_iter_batch_jobs_reports_malformed_lines,
+        test_resolve_output_path_rejects_escapes,
+        test_bad_output_is_a_per_line_error,
+        test_buckets_flush_at_batch_size_and_when_pending_overflows,
+        test_duplicate_output_is_recorded_as_overwrite,
+    ]
+    for test in tests:
+        test()
+        print(f"✅ {test.__name__}")
+    print("🎉 All batch mode checks passed!")
@@ -0,0 +1,88 @@
+import torch
+
+from guidance import GuidanceSchedule
+
+class StubUNet(torch.nn.Module):
+    """Records the batch size of every call instead of running a real UNet"""
+
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def forward(self, sample, timestep, encoder_hidden_states=None, return_dict=False):
+        self.batch_sizes.append(sample.shape[0])
+        return (sample + encoder_hidden_states.mean(dim=(1, 2)).view(-1, 1, 1, 1),)
+
+class StubPipeline:
+    """Mirrors the CFG and step-callback handling of StableDiffusionPipeline"""
+
+    def __init__(self):
+        self.unet = StubUNet()
+
+    def __call__(self, steps, guidance_scale, callback_on_step_end=None, callback_on_step_end_tensor_inputs=None):
+        self._guidance_scale = guidance_scale
+        self.num_timesteps = steps
+        latents = torch.zeros(1, 4, 8, 8)
+        prompt_embeds = torch.cat([torch.zeros(1, 77, 8), torch.ones(1, 77, 8)])
+
+        for i in range(steps):
+            do_cfg = self._guidance_scale > 1
+            latent_model_input = torch.cat([latents] * 2) if do_cfg else latents
+            noise_pred = self.unet(latent_model_input, i, encoder_hidden_states=prompt_embeds, return_dict=False)[0]
+            if do_cfg:
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
+            latents = latents - 0.1 * noise_pred
+
+            if callback_on_step_end is not None:
+                callback_outputs = callback_on_step_end(self, i, i, {"prompt_embeds": prompt_embeds})
+                prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
+
+        return latents
+
+def run_schedule(schedule, steps=10, guidance=8.0):
+    pipe = StubPipeline()
+    with schedule.apply(pipe, guidance) as schedule_kwargs:
+        latents = pipe(steps, guidance, **schedule_kwargs)
+    return pipe, latents
+
+def test_disabled_schedule_runs_full_cfg():
+    pipe, latents = run_schedule(GuidanceSchedule())
+    assert pipe.unet.batch_sizes == [2] * 10
+    assert latents.shape[0] == 1
+
+def test_truncate_drops_unconditional_branch():
+    schedule = GuidanceSchedule(cutoff=0.3, mode="truncate")
+    pipe, latents = run_schedule(schedule)
+    assert pipe.unet.batch_sizes == [2] * 7 + [1] * 3
+    assert latents.shape[0] == 1
+    assert (schedule.unet_evals, schedule.unet_evals_saved) == (17, 3)
+
+def test_reuse_evaluates_conditional_half_only():
+    schedule = GuidanceSchedule(cutoff=0.3, mode="reuse")
+    pipe, latents = run_schedule(schedule)
+    assert pipe.unet.batch_sizes == [2] * 7 + [1] * 3
+    assert latents.shape[0] == 1
+    assert (schedule.unet_evals, schedule.unet_evals_saved) == (17, 3)
+    # The forward override is removed after the call
+    assert "forward" not in pipe.unet.__dict__
+
+def test_reuse_with_curve_ending_at_one():
+    # Guidance reaches 1.0 on the last step, which drops CFG while reuse is active
+    schedule = GuidanceSchedule(cutoff=0.3, mode="reuse", guidance_end=1.0)
+    pipe, latents = run_schedule(schedule)
+    assert pipe.unet.batch_sizes == [2] * 7 + [1] * 3
+    assert latents.shape[0] == 1
+    assert (schedule.unet_evals, schedule.unet_evals_saved) == (17, 3)
+
+if __name__ == "__main__":
+    tests = [
+        test_disabled_schedule_runs_full_cfg,
+        test_truncate_drops_unconditional_branch,
+        test_reuse_evaluates_conditional_half_only,
+        test_reuse_with_curve_ending_at_one,
+    ]
+    for test in tests:
+        test()
+        print(f"✅ {test.__name__}")
+    print("🎉 All guidance schedule checks passed!")
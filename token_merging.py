@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Battle-Eternal Token Merging (ToMe for Stable Diffusion)
+
+At 512x768 and 768x512 the highest-resolution UNet blocks attend over 6144
+latent tokens, and self-attention over them dominates each CPU step. Token
+merging pairs up redundant (most similar) tokens before self-attention and
+copies the results back to every original token afterwards, so attention
+runs over fewer tokens at a small quality cost.
+
+The UNet's transformer blocks are patched in place and can be restored
+without reloading the model:
+
+    apply_token_merging(pipe, ratio=0.5)
+    reset_token_merging(pipe)  # before every pipeline call
+    remove_token_merging(pipe)
+
+Benchmark latency and quality against the unpatched UNet:
+
+    python token_merging.py benchmark --ratios 0.3 0.5 0.7 --seeds 1 2
+
+The merging code (do_nothing, bipartite_soft_matching_2d, compute_merge and
+the ToMeBlock forward) is adapted from tomesd by Daniel Bolya,
+https://github.com/dbolya/tomesd, under the MIT licence reproduced below.
+"""
+
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+import torch
+from diffusers.models.attention import BasicTransformerBlock
+
+from onnx_backend import is_onnx_pipeline
+
+# Adapted from tomesd (https://github.com/dbolya/tomesd)
+#
+# MIT License
+#
+# Copyright (c) 2023 Daniel Bolya
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+def do_nothing(x):
+    return x
+
+def bipartite_soft_matching_2d(metric, w, h, sx, sy, r, generator):
+    """Build merge/unmerge functions that remove r tokens from metric.
+
+    The latent grid is split into sx-by-sy windows with one random "dst"
+    token each; the r "src" tokens most similar to a dst token are averaged
+    into it. unmerge copies each merged result back to its source tokens.
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        # Pick one dst token per window, the rest are src
+        rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), generator=generator).to(metric.device)
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+
+        # Tokens outside whole windows (odd sizes) always stay src
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:(hsy * sy), :(wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        # dst tokens are -1 and src tokens 0, so argsort orders them dst|src
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        # Cosine similarity between every src and dst token
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+
+        # Merge the r src tokens with the best match
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+def compute_merge(x, tome_info):
+    """Merge functions for a block, or no-ops if its resolution is too low"""
+    latent_h, latent_w = tome_info["size"]
+    downsample = int(math.ceil(math.sqrt(latent_h * latent_w // x.shape[1])))
+
+    if downsample > tome_info["max_downsample"]:
+        return do_nothing, do_nothing
+
+    w = int(math.ceil(latent_w / downsample))
+    h = int(math.ceil(latent_h / downsample))
+    r = int(x.shape[1] * tome_info["ratio"])
+    return bipartite_soft_matching_2d(x, w, h, tome_info["sx"], tome_info["sy"], r, tome_info["generator"])
+
+def make_tome_block(block_class):
+    """Subclass a transformer block so self-attention runs on merged tokens"""
+
+    class ToMeBlock(block_class):
+        _parent = block_class
+
+        def forward(self, hidden_states, attention_mask=None, encoder_hidden_states=None,
+                    encoder_attention_mask=None, timestep=None, cross_attention_kwargs=None,
+                    class_labels=None, added_cond_kwargs=None):
+            merge, unmerge = compute_merge(hidden_states, self._tome_info)
+            cross_attention_kwargs = cross_attention_kwargs.copy() if cross_attention_kwargs is not None else {}
+
+            # Self-attention over merged tokens
+            norm_hidden_states = self.norm1(hidden_states)
+            attn_output = self.attn1(
+                merge(norm_hidden_states),
+                encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
+                attention_mask=attention_mask,
+                **cross_attention_kwargs
+            )
+            hidden_states = unmerge(attn_output) + hidden_states
+
+            # Cross-attention and feed-forward run on the full token set
+            if self.attn2 is not None:
+                norm_hidden_states = self.norm2(hidden_states)
+                attn_output = self.attn2(
+                    norm_hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    attention_mask=encoder_attention_mask,
+                    **cross_attention_kwargs
+                )
+                hidden_states = attn_output + hidden_states
+
+            norm_hidden_states = self.norm3(hidden_states)
+            hidden_states = self.ff(norm_hidden_states) + hidden_states
+            return hidden_states
+
+    return ToMeBlock
+
+def remove_token_merging(pipe):
+    """Restore the original transformer blocks"""
+    if is_onnx_pipeline(pipe):
+        return pipe
+
+    unet = pipe.unet
+    for module in unet.modules():
+        if hasattr(module, "_tome_info"):
+            module.__class__ = module._parent
+            del module._tome_info
+
+    hook = getattr(unet, "_tome_hook", None)
+    if hook is not None:
+        hook.remove()
+        del unet._tome_hook
+    return pipe
+
+def reset_token_merging(pipe):
+    """Reseed the dst-token choice; call before each pipeline call"""
+    if is_onnx_pipeline(pipe):
+        return pipe
+
+    for module in pipe.unet.modules():
+        if hasattr(module, "_tome_info"):
+            # Every patched block shares one tome_info
+            tome_info = module._tome_info
+            tome_info["generator"].manual_seed(tome_info["seed"])
+            break
+    return pipe
+
+def apply_token_merging(pipe, ratio=0.5, max_downsample=1, sx=2, sy=2, seed=0):
+    """Patch the UNet so self-attention merges `ratio` of its tokens.
+
+    Only blocks whose latent resolution is downsampled at most
+    max_downsample times are merged (1 = the 64x96 blocks at 512x768, where
+    attention cost is highest). Calling it again replaces the old settings.
+
+    The random dst-token choice is drawn from a generator seeded with `seed`.
+    Call reset_token_merging before each pipeline call so the same image seed
+    always gives the same result.
+    """
+    if is_onnx_pipeline(pipe):
+        print("⚠️  Token merging needs the torch backend, skipping")
+        return pipe
+
+    remove_token_merging(pipe)
+    if ratio <= 0:
+        return pipe
+
+    unet = pipe.unet
+    tome_info = {
+        "size": None,
+        "ratio": ratio,
+        "max_downsample": max_downsample,
+        "sx": sx,
+        "sy": sy,
+        "seed": seed,
+        "generator": torch.Generator().manual_seed(seed),
+    }
+
+    def start_unet_call(module, args, kwargs):
+        sample = args[0] if args else kwargs["sample"]
+        tome_info["size"] = (sample.shape[2], sample.shape[3])
+
+    unet._tome_hook = unet.register_forward_pre_hook(start_unet_call, with_kwargs=True)
+
+    patched = 0
+    for module in unet.modules():
+        # The merged forward covers plain layer-norm blocks, which is every
+        # block in SD 1.x checkpoints like Anything V5
+        if isinstance(module, BasicTransformerBlock) and module.norm_type == "layer_norm" and module.pos_embed is None:
+            module.__class__ = make_tome_block(module.__class__)
+            module._tome_info = tome_info
+            patched += 1
+
+    print(f"🧩 Token merging enabled: ratio {ratio}, {patched} transformer blocks patched")
+    return pipe
+
+def benchmark_token_merging(prompt, ratios, seeds, steps=25, guidance=8.0, width=512, height=768,
+                            output_dir="output/tome_benchmark"):
+    """Compare latency and output drift of each merge ratio against the unpatched UNet"""
+    from generate_anything_v5 import build_negative_prompt, run_seeded, setup_anything_v5_pipeline
+
+    pipe = setup_anything_v5_pipeline()
+    if pipe is None:
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    negative_prompt = build_negative_prompt()
+
+    print("🔥 Warming up...")
+    run_seeded(pipe, prompt, negative_prompt, seeds[0], 2, guidance, width, height)
+
+    baselines = {}
+    rows = []
+    for ratio in [0.0] + [r for r in ratios if r > 0]:
+        apply_token_merging(pipe, ratio)
+        for seed in seeds:
+            print(f"🎨 Ratio {ratio}, seed {seed}...")
+            image, seconds = run_seeded(pipe, prompt, negative_prompt, seed, steps, guidance, width, height)
+            image.save(os.path.join(output_dir, f"ratio_{ratio}_seed_{seed}.png"))
+
+            pixels = np.asarray(image, dtype=np.float32)
+            if ratio == 0.0:
+                baselines[seed] = (pixels, seconds)
+                mean_diff, psnr = 0.0, float("inf")
+            else:
+                diff = pixels - baselines[seed][0]
+                mean_diff = float(np.abs(diff).mean())
+                mse = float((diff ** 2).mean())
+                psnr = 10 * math.log10(255 ** 2 / mse) if mse > 0 else float("inf")
+
+            rows.append({
+                "ratio": ratio,
+                "seed": seed,
+                "seconds": round(seconds, 2),
+                "speedup": round(baselines[seed][1] / seconds, 2),
+                "mean_abs_diff": round(mean_diff, 3),
+                "psnr": round(psnr, 2),
+            })
+    remove_token_merging(pipe)
+
+    print(f"\n📊 Token merging vs unpatched UNet ({width}x{height}, {steps} steps)")
+    print(f"{'ratio':>6} {'seed':>6} {'seconds':>9} {'speedup':>8} {'mean diff':>10} {'PSNR dB':>8}")
+    for row in rows:
+        print(f"{row['ratio']:>6} {row['seed']:>6} {row['seconds']:>9} {row['speedup']:>7}x "
+              f"{row['mean_abs_diff']:>10} {row['psnr']:>8}")
+
+    report_path = os.path.join(output_dir, "benchmark.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        # inf isn't valid JSON, so the identical baseline PSNR is stored as null
+        json.dump({"prompt": prompt, "steps": steps, "guidance": guidance, "width": width, "height": height,
+                   "results": [dict(row, psnr=None if math.isinf(row["psnr"]) else row["psnr"]) for row in rows]},
+                  f, indent=2)
+    print(f"📄 Report saved: {report_path}")
+    print(f"🖼️  Compare images side by side in {output_dir}")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark token merging on the Anything V5 UNet')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    bench_parser = subparsers.add_parser('benchmark', help='Compare merge ratios against the unpatched UNet')
+    bench_parser.add_argument('--prompt', '-p', type=str,
+                              default="anime style portrait of Alexander, blonde hair, blue eyes, glasses, red hoodie, detailed art",
+                              help='Prompt used for every run')
+    bench_parser.add_argument('--ratios', type=float, nargs='+', default=[0.3, 0.5, 0.7], help='Merge ratios to test')
+    bench_parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2], help='Seeds to compare')
+    bench_parser.add_argument('--steps', '-s', type=int, default=25, help='Number of inference steps')
+    bench_parser.add_argument('--guidance', '-g', type=float, default=8.0, help='Guidance scale')
+    bench_parser.add_argument('--width', '-w', type=int, default=512, help='Image width')
+    bench_parser.add_argument('--height', type=int, default=768, help='Image height')
+
+    args = parser.parse_args()
+
+    benchmark_token_merging(
+        args.prompt,
+        args.ratios,
+        args.seeds,
+        steps=args.steps,
+        guidance=args.guidance,
+        width=args.width,
+        height=args.height
+    )
+
+if __name__ == "__main__":
+    main()